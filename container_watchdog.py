@@ -3,11 +3,15 @@ import sys
 import logging
 import time
 import json
+import random
 import os
 import re
 import smtplib
+from concurrent.futures import ThreadPoolExecutor
 from email.message import EmailMessage
+from typing import Optional
 import requests
+import urllib3
 import docker
 
 # Set logging options and variables
@@ -19,12 +23,31 @@ slack_webhook_url: str = os.getenv('SLACK_WEBHOOK_URL', '')
 email_sender: str = os.getenv('EMAIL_SENDER', '')
 email_receiver: str = os.getenv('EMAIL_RECEIVER', '')
 smtp_server: str = os.getenv('SMTP_SERVER', '')
-restarted_containers: list = []
-notification_content: dict = {}
+max_reconnect_interval: int = int(os.getenv('MAX_RECONNECT_INTERVAL', '600'))
+pool_size: int = int(os.getenv('WATCHDOG_POOL_SIZE', '16'))
+watchdog_label: str = os.getenv('WATCHDOG_LABEL', '')
+# Only watch containers carrying the label when one is given, otherwise watch all containers
+label_filter: dict = {'label': [watchdog_label]} if watchdog_label != "" else {}
+# Restart time by container id, and the time a container which could not be restarted yet is due to be rechecked
+restarted_containers: dict = {}
+retry_containers: dict = {}
+EMAIL_SANITIZE = re.compile('[^ :A-Za-z0-9]+')
+# Slack rejects messages with more than 50 blocks
+SLACK_MAX_BLOCKS = 50
+
+# Reuse one HTTPS connection to the Slack webhook between notifications
+SLACK_SESSION = requests.Session()
+SLACK_SESSION.headers.update({'Content-Type': 'application/json'})
+
+# Notifications are sent in the background so that Slack and SMTP round trips do not hold up event handling.
+# One worker per channel keeps the messages of each channel in order.
+SLACK_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+SMTP_EXECUTOR = ThreadPoolExecutor(max_workers=1)
 
 # Test and establish connection to docker socket
 try:
-    CLIENT = docker.from_env()
+    # One connection per startup pass worker
+    CLIENT = docker.from_env(max_pool_size=pool_size)
     CLIENT.version()
     logging.info("Connection to Docker socket OK")
 except Exception as err:
@@ -35,103 +58,204 @@ except Exception as err:
 def send_slack_message(content) -> None:
     if slack_webhook_url != "":
         try:
-            requests.post(slack_webhook_url, data=json.dumps(content),
-                          headers={'Content-Type': 'application/json'})
-            logging.info("Message sent to Slack webhook: %s", content['text'])
-        except (requests.exceptions.Timeout, ConnectionError) as err:
+            response = SLACK_SESSION.post(slack_webhook_url, data=json.dumps(content), timeout=5)
+            if response.ok:
+                logging.info("Message sent to Slack webhook: %s", content['text'])
+            else:
+                logging.error("Slack webhook rejected message with status %s: %s", response.status_code, response.text)
+        except requests.exceptions.RequestException as err:
             logging.error("%s", err)
 
 
 def send_smtp_message(content) -> None:
     if email_receiver != "" and smtp_server != "":
-        email_content: str = re.sub('[^ :A-Za-z0-9]+', '', content)
+        email_content: str = "\n".join(EMAIL_SANITIZE.sub('', line) for line in content.splitlines())
         email_message = EmailMessage()
         email_message.set_content(email_content)
         email_message['Subject'] = 'Container Watchdog Alert notification'
         email_message['From'] = email_sender
         email_message['To'] = email_receiver
-        mail = smtplib.SMTP(smtp_server, 25, timeout=40)
         try:
-            mail.send_message(email_message)
+            # Alerts can be hours apart and servers drop idle sessions, so each batch gets its own connection
+            with smtplib.SMTP(smtp_server, 25, timeout=10) as mail:
+                mail.send_message(email_message)
             logging.info("Email sent to %s with content: %s", email_receiver, email_content)
         except Exception as err:
             logging.error("%s", err)
-        mail.quit()
-
 
-def get_container_health_status(container_object) -> str:
-    try:
-        health_status = container_object.attrs['State']['Health']['Status']
-    except KeyError:
-        health_status = 'nokey'
-    return health_status
 
-def get_container_health_log(container_object) -> str:
+def fetch_last_health_output(container_id) -> Optional[str]:
     try:
-        health_log = container_object.attrs['State']['Health']['Log'][-1]['Output']
+        health_log = CLIENT.api.inspect_container(container_id)['State']['Health']['Log'][-1]['Output']
     except KeyError:
         health_log = 'nokey'
     except IndexError:
         health_log = 'empty'
+    except docker.errors.NotFound:
+        # Container was removed before it could be inspected
+        health_log = None
     return health_log
 
-def restart_container(container_object) -> None:
+
+def restart_container(container_id, container_name, container_status, container_health_status, container_health_log) -> dict:
     try:
-        container_object.restart()
-        logging.info("Restarted container: %s", container_object.name)
-        notification_content['text'] = ("[Container watchdog]: Container restarted\n"
-                                        "\tHost: [ *_{0}_* ]\n"
-                                        "\tContainer: [ *_{1}_* ]\n"
-                                        "\tState: [ *_{2}_* ]\n"
-                                        "\tHealthstatus: [ *_{3}_* ]\n"
-                                        "\tOutput: [ _{4}_ ]".format(docker_host, container_object.name, container_status, container_health_status, container_health_log))
-        if container_object.short_id not in restarted_containers:
-            restarted_containers.append(container_object.short_id)
+        CLIENT.api.restart(container_id)
+        logging.info("Restarted container: %s", container_name)
+        notification: dict = {'text': ("[Container watchdog]: Container restarted\n"
+                                       f"\tHost: [ *_{docker_host}_* ]\n"
+                                       f"\tContainer: [ *_{container_name}_* ]\n"
+                                       f"\tState: [ *_{container_status}_* ]\n"
+                                       f"\tHealthstatus: [ *_{container_health_status}_* ]\n"
+                                       f"\tOutput: [ _{container_health_log}_ ]")}
+        restarted_containers[container_id] = time.time()
     except Exception as err:
         logging.fatal("%s", err)
-        notification_content['text'] = ("[Container watchdog]: Docker daemon failed to restart container *{0}* on hostmachine *{1}*"
-                                        " with error message: _{2}_".format(container_object.name, docker_host, err))
+        retry_containers[container_id] = time.time() + polling_interval
+        notification = {'text': (f"[Container watchdog]: Docker daemon failed to restart container *{container_name}* on hostmachine *{docker_host}*"
+                                 f" with error message: _{err}_")}
+    return notification
+
+
+def container_recovered(container_id, container_name, container_status, container_health_status) -> dict:
+    logging.info("Container %s has recovered and is now healthy!", container_name)
+    restarted_containers.pop(container_id, None)
+    retry_containers.pop(container_id, None)
+    return {'text': ("[Container watchdog]: Container has recovered\n"
+                     f"\tHost: [ *_{docker_host}_* ]\n"
+                     f"\tContainer: [ *_{container_name}_* ]\n"
+                     f"\tState: [ *_{container_status}_* ]\n"
+                     f"\tHealthstatus: [ *_{container_health_status}_* ]")}
+
+
+def send_notifications(notifications) -> None:
+    # Send notifications collected together as one email and as few Slack messages as the block limit allows.
+    # Only the startup pass collects more than one, the event loop sends after every event.
+    if notifications:
+        for start in range(0, len(notifications), SLACK_MAX_BLOCKS):
+            slack_batch: list = notifications[start:start + SLACK_MAX_BLOCKS]
+            SLACK_EXECUTOR.submit(send_slack_message, {'text': "\n".join(notification['text'] for notification in slack_batch),
+                                                       'blocks': [{'type': 'section', 'text': {'type': 'mrkdwn', 'text': notification['text']}}
+                                                                  for notification in slack_batch]})
+        SMTP_EXECUTOR.submit(send_smtp_message, "\n\n".join(notification['text'] for notification in notifications))
+
 
+def handle_unhealthy_container(container_id, container_name, container_status) -> Optional[dict]:
+    restarted_at: Optional[float] = restarted_containers.get(container_id)
+    if restarted_at is not None and time.time() < restarted_at + polling_interval_after_restart:
+        # Give a restarted container time to recover before restarting it again
+        retry_containers[container_id] = restarted_at + polling_interval_after_restart
+        logging.info("Container %s was restarted less than %s seconds ago, checking it again later", container_name, polling_interval_after_restart)
+        return None
+    container_health_log = fetch_last_health_output(container_id)
+    if container_health_log is None:
+        logging.debug("Container %s was removed before it could be restarted", container_name)
+        return None
+    logging.error("Found container in unhealthy state! Container: '%s' has health status: '%s' and container status: '%s' with output log: %s",
+                  container_name, 'unhealthy', container_status, container_health_log)
+    return restart_container(container_id, container_name, container_status, 'unhealthy', container_health_log)
 
-def container_recovered(container_object) -> None:
-    logging.info("Container %s has recovered and is now healthy!", container_object.name)
-    notification_content['text'] = ("[Container watchdog]: Container has recovered\n"
-                                        "\tHost: [ *_{0}_* ]\n"
-                                        "\tContainer: [ *_{1}_* ]\n"
-                                        "\tState: [ *_{2}_* ]\n"
-                                        "\tHealthstatus: [ *_{3}_* ]".format(docker_host, container_object.name, container_status, container_health_status))
 
-    restarted_containers.remove(container_object.short_id)
+def restart_unhealthy_containers(unhealthy_list) -> list:
+    # The inspects and restarts are independent blocking calls to the Docker socket, so they are run concurrently.
+    with ThreadPoolExecutor(max_workers=pool_size) as executor:
+        notification_list: list = list(executor.map(handle_unhealthy_container,
+                                                    [unhealthy_container['Id'] for unhealthy_container in unhealthy_list],
+                                                    [unhealthy_container['Names'][0].lstrip('/') for unhealthy_container in unhealthy_list],
+                                                    [unhealthy_container['State'] for unhealthy_container in unhealthy_list]))
+    return [notification for notification in notification_list if notification is not None]
 
 
-# Run loop indefinetly polling every $POLLING_INTERVAL normally or in $POLLING_INTERVAL_AFTER_RESTART after watchdog has restarted a container.
-while True:
-    restart_status: bool = False
-    container_list: list = CLIENT.containers.list()
-    for container in container_list:
-        container_status = container.status
-        container_health_status: str = get_container_health_status(container)
+def recheck_containers() -> None:
+    # Containers whose restart failed or was held back will not emit a new health_status event while they stay
+    # unhealthy, so the ones which are due are listed again and restarted if still unhealthy.
+    now: float = time.time()
+    due_ids: list = [container_id for container_id, due_time in retry_containers.items() if due_time <= now]
+    if due_ids:
+        try:
+            unhealthy_list: list = CLIENT.api.containers(filters={'id': due_ids, 'health': ['unhealthy']})
+            notifications: list = restart_unhealthy_containers(unhealthy_list)
+        except docker.errors.APIError as err:
+            logging.error("Failed to recheck containers, retrying later: %s", err)
+            return
+        for container_id in due_ids:
+            # Keep containers which were scheduled again while being rechecked
+            if retry_containers.get(container_id, now) <= now:
+                retry_containers.pop(container_id, None)
+        send_notifications(notifications)
+
+
+def handle_event(event) -> bool:
+    container_id: str = event['Actor']['ID']
+    container_name = event['Actor']['Attributes']['name']
+    # Health status events are only emitted for running containers
+    container_status = 'running'
+    container_health_status = event['Action'].split(': ', 1)[-1]
+    notifications: list = []
+    try:
         # Check if the container was restarted previously and is now healthy.
         # Send Slack/email notification. Remove from a list of restarted containers
-        if container.short_id in restarted_containers and container_health_status == 'healthy':
-            container_recovered(container)
-            send_slack_message(notification_content)
-            send_smtp_message(notification_content['text'])
-        # If container is in unhealthy or exited status, restart and send Slack/Email notification.
+        if container_id in restarted_containers and container_health_status == 'healthy':
+            notifications.append(container_recovered(container_id, container_name, container_status, container_health_status))
+        # If container turned unhealthy, restart and send Slack/Email notification.
         elif container_health_status == 'unhealthy':
-            container_health_log: str = get_container_health_log(container)
-            logging.error("Found container in unhealthy state! Container: '%s' has health status: '%s' and container status: '%s' with output log: %s",
-                          container.name, container_health_status, container_status, container_health_log)
-            restart_container(container)
-            send_slack_message(notification_content)
-            send_smtp_message(notification_content['text'])
-            restart_status = True
-        logging.debug('%s - %s - %s', container.name, container_health_status, container_status)
-
-    # Wait to poll again, longer if restarts were done in previous loop
-    if restart_status is True:
-        logging.info("Waiting %s seconds until next polling, because container was restarted", polling_interval_after_restart)
-        time.sleep(polling_interval_after_restart)
-    elif restart_status is False:
-        logging.info("All containers are in healthy state!")
-        time.sleep(polling_interval)
+            notification = handle_unhealthy_container(container_id, container_name, container_status)
+            if notification is not None:
+                notifications.append(notification)
+    except docker.errors.APIError as err:
+        logging.error("Failed to handle event '%s' of container %s, retrying later: %s", event['Action'], container_name, err)
+        return False
+    send_notifications(notifications)
+    logging.debug('%s - %s - %s', container_name, container_health_status, container_status)
+    return True
+
+
+def main() -> None:
+    # The event stream is opened from just before the startup listing. Events from the second before that are
+    # replayed by the daemon and skipped by their nanosecond timestamp. A container which turns unhealthy between
+    # taking the timestamp and the listing is seen by both, its replayed event falls within
+    # $POLLING_INTERVAL_AFTER_RESTART of the startup restart and only schedules a recheck. Health changes during a
+    # long startup pass can still be missed if they fall out of the daemon's small in-memory event backlog.
+    last_event_time_nano: int = time.time_ns()
+    last_event_time: int = last_event_time_nano // 1000000000
+    reconnect_interval: float = 0.5
+
+    # Start with a single filtered listing of unhealthy containers. They will not emit a new health_status
+    # event, so they are handled here before starting to consume the event stream. Raw dicts from the low-level API are
+    # used and only the last health check output is inspected for the containers which need a restart.
+    unhealthy_list: list = CLIENT.api.containers(filters={'health': ['unhealthy'], **label_filter})
+    send_notifications(restart_unhealthy_containers(unhealthy_list))
+    logging.info("Watching Docker events for container health changes")
+
+    # Consume Docker events indefinitely. Container name and state are read from the event itself, the daemon is only
+    # inspected for the last health check output of containers which need a restart. The stream ends every
+    # $POLLING_INTERVAL to recheck containers which could not be restarted yet. It is reopened from the time of the
+    # last handled event, skipping events which were already handled.
+    while True:
+        try:
+            recheck_time: int = int(time.time()) + polling_interval
+            event_stream = CLIENT.events(since=last_event_time, until=recheck_time, decode=True,
+                                         filters={'type': 'container', 'event': ['health_status'], **label_filter})
+            # The stream is open, so the daemon is reachable again
+            reconnect_interval = 0.5
+            for event in event_stream:
+                if event['timeNano'] <= last_event_time_nano:
+                    continue
+                if not handle_event(event):
+                    # Leave the event unhandled, it is replayed when the stream is reopened after the recheck time
+                    event_stream.close()
+                    time.sleep(max(0.0, recheck_time - time.time()))
+                    break
+                last_event_time, last_event_time_nano = event['time'], event['timeNano']
+            else:
+                # Every event before the stream ended has been handled, so replays can start from there
+                last_event_time = max(last_event_time, min(recheck_time, int(time.time())) - 1)
+            recheck_containers()
+        except (docker.errors.APIError, requests.exceptions.ConnectionError, urllib3.exceptions.ProtocolError) as err:
+            # Back off exponentially with jitter while the daemon is unavailable instead of hammering its socket
+            reconnect_interval = min(max_reconnect_interval, reconnect_interval * 2 + random.uniform(0, 1))
+            logging.error("Lost connection to Docker events stream, retrying in %.1f seconds: %s", reconnect_interval, err)
+            time.sleep(reconnect_interval)
+
+
+if __name__ == '__main__':
+    main()